@@ -27,7 +27,7 @@ from latch.types.metadata import (
     Text,
 )
 
-from wf.task import create_track, format_bed_files, methyl_task
+from wf.task import create_track, format_and_diff
 
 
 @dataclass
@@ -38,10 +38,10 @@ class Sample:
 
 
 @dataclass
-class ProcessedBED:
-    sample_name: str
-    bed_file: LatchFile
-    treatment: bool = False
+class ProcessedBEDBatch:
+    names: List[str]
+    paths: List[str]
+    treatments: List[int]
 
 
 class FileFormat(Enum):
@@ -269,16 +269,9 @@ def dmr_methylkit(
 
     """
 
-    processed_bed_files = format_bed_files(
+    processed_beds, methyl_results = format_and_diff(
         samples=samples,
         output_directory=output_directory,
-        track_name=track_name,
-        bed_format=bed_format,
-    )
-
-    methyl_results = methyl_task(
-        samples=processed_bed_files,
-        output_directory=output_directory,
         base_cov_val=base_cov_val,
         tiling_val=tiling_val,
         tile_coverage=tile_coverage,
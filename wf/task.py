@@ -1,12 +1,17 @@
 import json
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 from typing import Annotated, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from latch.resources.launch_plan import LaunchPlan
 from latch.resources.tasks import medium_task, small_task
 from latch.resources.workflow import workflow
@@ -24,10 +29,10 @@ class Sample:
 
 
 @dataclass
-class ProcessedBED:
-    sample_name: str
-    bed_file: LatchFile
-    treatment: bool = False
+class ProcessedBEDBatch:
+    names: List[str]
+    paths: List[str]
+    treatments: List[int]
 
 
 class FileFormat(Enum):
@@ -41,100 +46,112 @@ class Genome(Enum):
     hg19 = "hg19"
 
 
-@medium_task
+# CPUs requested by medium_task. Inside the task container os.cpu_count()
+# reports the whole node, not this allocation.
+MEDIUM_TASK_CPUS = 30
+
+
+def available_cpus() -> int:
+    return max(1, min(len(os.sched_getaffinity(0)), MEDIUM_TASK_CPUS))
+
+
 def format_bed_files(
     samples: List[Sample],
-    output_directory: LatchOutputDir,
-    track_name: str,
+    output_dirpath: Path,
     bed_format: FileFormat = FileFormat.bismark_cov,
-) -> List[ProcessedBED]:
-
-    track_name = track_name.replace(" ", "_")
+) -> ProcessedBEDBatch:
 
-    output_dir = f"{track_name}/processed_beds"
-    output_dirpath = Path(output_dir).resolve()
     output_dirpath.mkdir(parents=True, exist_ok=True)
     print("BED File Output Directory: ", output_dirpath)
 
-    bed_results = []
-
-    if bed_format == FileFormat.bedmethyl:
-
-        for s in samples:
-            sample_name = s.sample_name
-            table = pd.read_csv(s.bed_file.local_path, sep="\t", header=None)
-            table[11] = table[10] * 0.01 * table[9]
-            table[12] = table[10] * 0.01
-            table[11] = table[11].round()
-            table[11] = pd.to_numeric(table[11], downcast="integer")
-            bed_table = table[[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12]]
-            bed_table = bed_table.fillna(0)
-            # table[11] = table[10] * 0.01 * table[9]
-            # table[11] = table[11].round()
-            # table[11] = pd.to_numeric(table[11], downcast="integer")
-            # bed_table = table[[0, 1, 2, 5, 9, 11]]
-            # bed_table.columns = ["chr", "start", "end", "strand", "coverage", "numC"]
-            # bed_table = bed_table.fillna(0)
-            s_path = str(output_dirpath) + f"/{sample_name}.bed"
-            bed_table.to_csv(
-                s_path,
-                index=False,
-                header=False,
-                sep="\t",
+    def process_sample(s: Sample) -> str:
+        sample_name = s.sample_name
+        s_path = str(output_dirpath) + f"/{sample_name}.bed"
+
+        if bed_format == FileFormat.bedmethyl:
+            table = pacsv.read_csv(
+                s.bed_file.local_path,
+                read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+                parse_options=pacsv.ParseOptions(delimiter="\t"),
+                # Numeric BED fields are pinned so a column left blank in every
+                # row is not inferred as the null type, which cannot be filled
+                convert_options=pacsv.ConvertOptions(
+                    column_types={
+                        "f1": pa.int64(),
+                        "f2": pa.int64(),
+                        "f4": pa.int64(),
+                        "f6": pa.int64(),
+                        "f7": pa.int64(),
+                        "f9": pa.int32(),
+                        "f10": pa.float64(),
+                    }
+                ),
             )
-            print(s_path)
-            output_location = f"{output_directory.remote_directory}/{track_name}/processed_beds/{s.sample_name}.bed"
-            print(output_location)
-
-            bed_results.append(
-                ProcessedBED(
-                    sample_name=s.sample_name,
-                    bed_file=LatchFile(
-                        s_path,
-                        output_location,
-                    ),
-                    treatment=s.treatment,
-                )
+            # Uncovered positions carry no methylation calls and are discarded
+            # by methRead anyway, so drop them before doing any work on them
+            table = table.filter(pc.greater(table["f9"], 0))
+            freq = pc.multiply(table["f10"], 0.01)
+            numC = pc.cast(
+                pc.round(pc.multiply(freq, table["f9"])), pa.int32(), safe=False
+            )
+            columns = table.columns[:10] + [numC, freq]
+            # A text field left blank in every row is still read as the null
+            # type, which has to be given a real type before it can be filled
+            bed_table = pa.table(
+                [
+                    pc.fill_null(c.cast(pa.int64()) if pa.types.is_null(c.type) else c, 0)
+                    if c.null_count
+                    else c
+                    for c in columns
+                ],
+                names=table.column_names[:10] + ["f11", "f12"],
+            )
+        else:
+            bed_table = pacsv.read_csv(
+                s.bed_file.local_path,
+                read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+                parse_options=pacsv.ParseOptions(delimiter="\t"),
             )
-    else:
-
-        for s in samples:
-            sample_name = s.sample_name
-            bed_table = pd.read_csv(s.bed_file.local_path, sep="\t", header=None)
             print("------------------------")
             print(f"Sample: {sample_name}")
-            print(bed_table.head())
+            print(bed_table.slice(0, 5).to_pandas())
             print("\n")
-            s_path = str(output_dirpath) + f"/{sample_name}.bed"
-            bed_table.to_csv(
-                s_path,
-                index=False,
-                header=False,
-                sep="\t",
-            )
-            print(s_path)
-            output_location = f"{output_directory.remote_directory}/{track_name}/processed_beds/{s.sample_name}.bed"
-            print(output_location)
-
-            bed_results.append(
-                ProcessedBED(
-                    sample_name=s.sample_name,
-                    bed_file=LatchFile(
-                        s_path,
-                        output_location,
-                    ),
-                    treatment=s.treatment,
-                )
-            )
 
-    return bed_results
+        # Arrow's "needed" style quotes every string cell, so it is only used
+        # when some cell contains a quote that the unquoted style cannot write
+        needs_quoting = any(
+            pa.types.is_string(c.type) and pc.any(pc.match_substring(c, '"')).as_py()
+            for c in bed_table.columns
+        )
+        pacsv.write_csv(
+            bed_table,
+            s_path,
+            write_options=pacsv.WriteOptions(
+                include_header=False,
+                delimiter="\t",
+                quoting_style="needed" if needs_quoting else "none",
+            ),
+        )
 
+        print(s_path)
+        return s_path
 
-@medium_task
-def methyl_task(
-    samples: List[ProcessedBED],
-    output_directory: LatchOutputDir,
-    track_name: str,
+    # Samples are independent and the parsing/writing runs in C code that
+    # releases the GIL, so a thread pool processes them concurrently
+    max_workers = max(1, min(len(samples), available_cpus()))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        bed_paths = list(executor.map(process_sample, samples))
+
+    return ProcessedBEDBatch(
+        names=[s.sample_name for s in samples],
+        paths=bed_paths,
+        treatments=[1 if s.treatment else 0 for s in samples],
+    )
+
+
+def run_methylkit(
+    samples: ProcessedBEDBatch,
+    output_dirpath: Path,
     base_cov_val: int = 3,
     tiling_val: int = 200,
     tile_coverage: int = 10,
@@ -142,30 +159,14 @@ def methyl_task(
     q_val: float = 0.05,
     bed_format: FileFormat = FileFormat.bismark_cov,
     genome: Genome = Genome.hg19,
-) -> LatchDir:
-
-    track_name = track_name.replace(" ", "_")
-
-    file_names = []
-    file_paths = []
-    treatments = []
-
-    for s in samples:
-        file_names.append(s.sample_name)
-        file_paths.append(s.bed_file.local_path)
-        if s.treatment:
-            treatments.append(1)
-        else:
-            treatments.append(0)
+):
 
     delimiter = ","
-    file_names = delimiter.join(file_names)
-    file_paths = delimiter.join(file_paths)
-    treatements_str = ",".join(map(str, treatments))
-    print("TREATMENTS", treatments, treatements_str)
+    file_names = delimiter.join(samples.names)
+    file_paths = delimiter.join(samples.paths)
+    treatements_str = delimiter.join(map(str, samples.treatments))
+    print("TREATMENTS", treatements_str)
 
-    output_dir = f"{track_name}/methylkit"
-    output_dirpath = Path(output_dir).resolve()
     output_dirpath.mkdir(parents=True, exist_ok=True)
     print("MethylKit Output Directory: ", output_dirpath)
 
@@ -175,59 +176,88 @@ def methyl_task(
     if bed_format == FileFormat.bismark_cytosine:
         bed_format_str = "bismark_cytosine"
 
-    print(
-        " ".join(
-            [
-                "Rscript",
-                "methylkit_task.R",
-                str(file_names),
-                str(file_paths),
-                str(output_dirpath),
-                str(base_cov_val),
-                str(tiling_val),
-                str(tile_coverage),
-                str(difference_val),
-                str(q_val),
-                str(treatements_str),
-                str(bed_format_str),
-                str(genome.value),
-            ]
-        )
+    rscript_args = [
+        "Rscript",
+        "methylkit_task.R",
+        str(file_names),
+        str(file_paths),
+        str(output_dirpath),
+        str(base_cov_val),
+        str(tiling_val),
+        str(tile_coverage),
+        str(difference_val),
+        str(q_val),
+        str(treatements_str),
+        str(bed_format_str),
+        str(genome.value),
+        str(available_cpus()),
+    ]
+    print(" ".join(rscript_args))
+
+    subprocess.run(rscript_args, check=True)
+
+
+@medium_task
+def format_and_diff(
+    samples: List[Sample],
+    output_directory: LatchOutputDir,
+    track_name: str,
+    base_cov_val: int = 3,
+    tiling_val: int = 200,
+    tile_coverage: int = 10,
+    difference_val: int = 25,
+    q_val: float = 0.05,
+    bed_format: FileFormat = FileFormat.bismark_cov,
+    genome: Genome = Genome.hg19,
+) -> Tuple[LatchDir, LatchDir]:
+
+    track_name = track_name.replace(" ", "_")
+
+    # Formatting and methylKit share a task so the processed BEDs are read
+    # from local disk instead of round-tripping through object storage
+    beds_dirpath = Path(f"{track_name}/processed_beds").resolve()
+    processed_beds = format_bed_files(
+        samples=samples,
+        output_dirpath=beds_dirpath,
+        bed_format=bed_format,
     )
 
-    subprocess.run(
-        " ".join(
-            [
-                "Rscript",
-                "methylkit_task.R",
-                str(file_names),
-                str(file_paths),
-                str(output_dirpath),
-                str(base_cov_val),
-                str(tiling_val),
-                str(tile_coverage),
-                str(difference_val),
-                str(q_val),
-                str(treatements_str),
-                str(bed_format_str),
-                str(genome.value),
-            ]
-        ),
-        check=True,
-        shell=True,
+    methylkit_dirpath = Path(f"{track_name}/methylkit").resolve()
+    run_methylkit(
+        samples=processed_beds,
+        output_dirpath=methylkit_dirpath,
+        base_cov_val=base_cov_val,
+        tiling_val=tiling_val,
+        tile_coverage=tile_coverage,
+        difference_val=difference_val,
+        q_val=q_val,
+        bed_format=bed_format,
+        genome=genome,
     )
 
-    output_location = (
+    beds_location = f"{output_directory.remote_directory}/{track_name}/processed_beds"
+    methylkit_location = (
         f"{output_directory.remote_directory}/{track_name}/methylkit_results"
     )
-    return LatchDir(str(output_dirpath), output_location)
+    return (
+        LatchDir(str(beds_dirpath), beds_location),
+        LatchDir(str(methylkit_dirpath), methylkit_location),
+    )
+
 
+def interpolate_colors(normalized: np.ndarray) -> np.ndarray:
+    # Red (255,0,0) to Blue (0,0,255), reusing one scratch buffer for both channels
+    scaled = np.subtract(1, normalized, dtype=np.float64)
+    scaled *= 255
+    red = scaled.astype(np.int32)
+    np.multiply(normalized, 255, out=scaled)
+    blue = scaled.astype(np.int32)
 
-def interpolate_color(normalized_val):
-    # Red (255,0,0) to Blue (0,0,255)
-    red = int((1 - normalized_val) * 255)
-    blue = int(normalized_val * 255)
-    return f"{red},0,{blue}"
+    # Only a few hundred distinct colors exist, so format each of them once
+    # and index into that palette instead of formatting every row
+    codes, inverse = np.unique(red * 256 + blue, return_inverse=True)
+    palette = np.array([f"{c // 256},0,{c % 256}" for c in codes.tolist()], dtype=object)
+    return palette[inverse.reshape(-1)]
 
 
 @small_task
@@ -242,46 +272,50 @@ def create_track(
     output_dirpath.mkdir(parents=True, exist_ok=True)
     print("IGV Track Output Directory: ", output_dirpath)
 
-    file_path = ""
-    for file in DMR_results.iterdir():
-        current = file.local_path
-        if "DMR_regions.csv" in current:
-            file_path = current
+    expected_path = Path(DMR_results.local_path) / "DMR_regions.csv"
+    if expected_path.exists():
+        file_path = str(expected_path)
+    else:
+        file_path = next(
+            (
+                file.local_path
+                for file in DMR_results.iterdir()
+                if "DMR_regions.csv" in file.local_path
+            ),
+            None,
+        )
+        if file_path is None:
+            raise FileNotFoundError(
+                f"DMR_regions.csv not found in {DMR_results.remote_path}"
+            )
 
     table = pd.read_csv(file_path)
 
     table.columns = ["chr", "start", "end", "strand", "pvalue", "qvalue", "meth.diff"]
     df = table.copy()
-    min_pval = df["pvalue"].min()
-    max_pval = df["pvalue"].max()
+    pvalues = df["pvalue"].to_numpy(dtype=np.float64)
+    min_pval = pvalues.min() if len(pvalues) else 0
+    max_pval = pvalues.max() if len(pvalues) else 0
 
     # Avoid division by zero in case all p-values are the same
     if min_pval == max_pval:
-        df["normalized"] = 1
+        normalized = np.ones(len(pvalues))
     else:
-        df["normalized"] = (df["pvalue"] - min_pval) / (max_pval - min_pval)
+        normalized = (pvalues - min_pval) / (max_pval - min_pval)
 
-    # Function to interpolate between red and blue based on the normalized p-value
-    df["color"] = df["normalized"].apply(interpolate_color)
+    # Interpolate between red and blue based on the normalized p-value
+    df["color"] = interpolate_colors(normalized)
     df["score"] = 0
     df["strand"] = "."
     df["1_o"] = df["start"]
     df["2_o"] = df["end"]
-    df["pvalue"] = df["pvalue"].apply(str)
-    df["qvalue"] = df["qvalue"].apply(str)
-    df["meth.diff"] = df["meth.diff"].apply(str)
-    df["name"] = df["qvalue"]
+    df["name"] = df["qvalue"].astype(str)
     df = df[["chr", "start", "end", "name", "score", "strand", "1_o", "2_o", "color"]]
     df_path = str(output_dirpath) + f"/IGV_track.bed"
-    df.to_csv(df_path, index=False, header=False, sep="\t")
     str_track_name = f'track name="{track_name}" description="." itemRgb="On"'
-    with open(df_path, "r") as file:
-        original_content = file.read()
-
-    new_content = f"{str_track_name}\n{original_content}"
-
     with open(df_path, "w") as file:
-        file.write(new_content)
+        file.write(f"{str_track_name}\n")
+        df.to_csv(file, index=False, header=False, sep="\t")
 
     output_location = f"{output_directory.remote_directory}/{track_name}/IGV_tracks"
     return LatchDir(str(output_dirpath), output_location)